@@ -1,58 +1,261 @@
 import argparse
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import queue
+import selectors
+import socket
 import time
-from datetime import datetime, timezone
 import os
 import psutil
+import signal
 import sqlite3
+import sys
+import threading
+
+try:
+    import apsw  # optional thinner SQLite binding; stdlib sqlite3 is used when it's missing
+except ImportError:
+    apsw = None
+
+METRICS_INSERT = "INSERT OR IGNORE INTO metrics VALUES (?,?,?,?,?,?)"  # a duplicate ts (clock step, second monitor) is skipped
+EVENTS_INSERT = "INSERT INTO events VALUES (?,?,?)"
+DB_ERRORS = (sqlite3.Error, apsw.Error) if apsw else (sqlite3.Error,)
+# retrying these can never succeed, so the batch that raised them is dropped
+PERMANENT_DB_ERRORS = (sqlite3.IntegrityError, apsw.ConstraintError) if apsw else (sqlite3.IntegrityError,)
+# schema mismatches with an existing DB surface as generic errors, so match on the message
+SCHEMA_ERROR_MARKERS = ("columns but", "no such table", "has no column named")
+MAX_BUFFERED_ROWS = 10_000  # samples held in memory while the DB keeps failing
+
+_TZ_SUFFIX = {}  # tm_gmtoff -> "+HHMM", so DST switches still get the right offset
 
 def iso_now():
-    return datetime.now(timezone.utc).astimezone().strftime('%Y-%m-%d %H:%M:%S%z')
+    # microseconds keep ts unique, since it is the metrics primary key
+    now = time.time()
+    t = time.localtime(now)
+    suffix = _TZ_SUFFIX.get(t.tm_gmtoff)
+    if suffix is None:
+        off = abs(t.tm_gmtoff) // 60
+        suffix = _TZ_SUFFIX[t.tm_gmtoff] = f"{'-' if t.tm_gmtoff < 0 else '+'}{off // 60:02d}{off % 60:02d}"
+    return f"{time.strftime('%Y-%m-%d %H:%M:%S', t)}.{int(now % 1 * 1_000_000):06d}{suffix}"
 
-def init_logger(path, max_bytes, backups):
-    os.makedirs(os.path.dirname(path), exist_ok=True)
+# Only stats the log path once a rollover is actually due, instead of on every emit (gh-105887)
+class FastRotatingFileHandler(RotatingFileHandler):
+    def shouldRollover(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        if self.maxBytes <= 0:
+            return False
+        msg = "%s\n" % self.format(record)
+        self.stream.seek(0, 2)
+        if self.stream.tell() + len(msg) < self.maxBytes:
+            return False
+        # bpo-45401: never roll over anything other than a regular file
+        return not (os.path.exists(self.baseFilename) and not os.path.isfile(self.baseFilename))
+
+def init_logger(path, max_bytes, backups, metrics_only=False):
+    log_dir = os.path.dirname(path)
+    if log_dir: os.makedirs(log_dir, exist_ok=True)  # bare filename: logs go to the CWD
+    # the format only uses asctime/levelname/message, so skip the caller stack walk and
+    # thread/process lookups that every LogRecord would otherwise pay for
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
     logger = logging.getLogger("system_health")
-    logger.setLevel(logging.INFO)
+    # metrics_only: the DB holds the samples, so INFO summaries are only shown on an interactive console
+    interactive = sys.stderr.isatty()
+    logger.setLevel(logging.INFO if not metrics_only or interactive else logging.WARNING)
 
     fmt = logging.Formatter("[%(asctime)s] %(levelname)-7s %(message)s")
-    handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+    handler = FastRotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
     handler.setFormatter(fmt)
-    logger.addHandler(handler)
+    if metrics_only: handler.setLevel(logging.WARNING)
 
     console = logging.StreamHandler()
     console.setFormatter(fmt)
-    logger.addHandler(console)
+
+    # file/console I/O happens on the listener thread so the sampling loop never blocks on it
+    q = queue.Queue(-1)
+    logger.addHandler(QueueHandler(q))
+    listener = QueueListener(q, handler, console, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
 
     return logger
 
-def init_db(path):
-    conn = sqlite3.connect(path, check_same_thread=False)
+def init_db(path, synchronous="NORMAL"):
+    # autocommit mode (apsw's default): transactions are opened explicitly in flush_db
+    if apsw:
+        conn = apsw.Connection(path)
+    else:
+        conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
     cur = conn.cursor()
+    # WAL + relaxed sync: commits append to the WAL instead of fsyncing a rollback journal
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute(f"PRAGMA synchronous={synchronous}")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA busy_timeout=5000")
+    cur.execute("PRAGMA wal_autocheckpoint=1000")  # keep checkpoints small and frequent
+    # WITHOUT ROWID: rows live directly in the ts-keyed B-tree, so ts range reads need no extra index
     cur.execute("""CREATE TABLE IF NOT EXISTS metrics (
-        ts TEXT, cpu_pct REAL, mem_pct REAL, disk_pct REAL, net_sent INTEGER, net_recv INTEGER)""")
+        ts TEXT PRIMARY KEY, cpu_pct REAL, mem_pct REAL, disk_pct REAL, net_sent INTEGER, net_recv INTEGER)
+        WITHOUT ROWID""")
     cur.execute("""CREATE TABLE IF NOT EXISTS events (
         ts TEXT, level TEXT, message TEXT)""")
-    conn.commit()
     return conn
 
-def get_snapshot(prev_net):
-    cpu = psutil.cpu_percent()
-    mem = psutil.virtual_memory().percent
-    disk = psutil.disk_usage("/").percent
-    net = psutil.net_io_counters()
-    sent, recv = net.bytes_sent, net.bytes_recv
+def flush_db(cur, metric_rows, event_rows):
+    if not metric_rows and not event_rows: return
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.executemany(METRICS_INSERT, metric_rows)
+        if event_rows: cur.executemany(EVENTS_INSERT, event_rows)
+        cur.execute("COMMIT")
+    except DB_ERRORS:
+        try:
+            cur.execute("ROLLBACK")
+        except DB_ERRORS:
+            pass  # SQLite already rolled back (e.g. disk full); keep the original error
+        raise
+    metric_rows.clear()
+    event_rows.clear()
+
+def is_permanent_db_error(e):
+    return isinstance(e, PERMANENT_DB_ERRORS) or any(m in str(e) for m in SCHEMA_ERROR_MARKERS)
+
+def db_writer(q, conn, batch=1):
+    # Drains (metric_row, event_rows) samples off the sampling thread; None means stop.
+    logger = logging.getLogger("system_health")
+    cur = conn.cursor()  # one cursor reused for every flush
+    metric_rows, event_rows = [], []
+    max_rows = max(MAX_BUFFERED_ROWS, batch)
+    last_err = None  # last reported flush error, so an ongoing outage is logged once
+    discarded = 0  # samples pushed out by the buffer cap during the current outage
+    running = True
+    while running:
+        item = q.get()
+        while True:
+            if item is None:
+                running = False
+                break
+            metric_rows.append(item[0])
+            event_rows.extend(item[1])
+            try:
+                item = q.get_nowait()  # group-commit whatever else is already queued
+            except queue.Empty:
+                break
+        if len(metric_rows) > max_rows:
+            # the DB has been failing for a while: keep only the newest samples
+            if not discarded:
+                logger.warning("DB write buffer full (%d samples), discarding oldest samples", max_rows)
+            discarded += len(metric_rows) - max_rows
+            del metric_rows[:-max_rows]
+            oldest = metric_rows[0][0]
+            event_rows[:] = [r for r in event_rows if r[0] >= oldest]
+        if len(metric_rows) >= batch or not running:
+            try:
+                flush_db(cur, metric_rows, event_rows)
+                if discarded:
+                    logger.warning("DB writes recovered; %d samples were discarded while it was unavailable", discarded)
+                last_err, discarded = None, 0
+            except DB_ERRORS as e:
+                err = f"{type(e).__name__}: {e}"
+                if is_permanent_db_error(e):
+                    if err != last_err:
+                        logger.error("Dropping samples that cannot be written to DB: %s", err)
+                    metric_rows.clear()
+                    event_rows.clear()
+                elif err != last_err:
+                    # e.g. database locked or disk full: rows stay buffered until the DB accepts them
+                    logger.warning("Failed to write metrics to DB, will retry: %s", err)
+                last_err = err
+    if metric_rows:
+        logger.error("Discarding %d unsaved samples at shutdown: %s", len(metric_rows), last_err)
+
+# Linux fast path: read /proc directly instead of going through several psutil calls
+PROC_FAST = sys.platform.startswith("linux") and os.path.exists("/proc/stat")
+HAS_STATVFS = hasattr(os, "statvfs")  # POSIX only; Windows goes through psutil
+_prev_cpu_times = None
+
+def _read_proc(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        chunks = []
+        while True:
+            b = os.read(fd, 65536)
+            if not b: break
+            chunks.append(b)
+        return b"".join(chunks)
+    finally:
+        os.close(fd)
+
+def _proc_snapshot():
+    global _prev_cpu_times
+    stat = _read_proc("/proc/stat")
+    f = [int(x) for x in stat[:stat.index(b"\n")].split()[1:]]
+    # same accounting as psutil: guest time is already included in user/nice
+    total = sum(f[:8])
+    idle = f[3] + f[4]
+    prev, _prev_cpu_times = _prev_cpu_times, (total, idle)
+    if prev and total > prev[0]:
+        cpu = round(100.0 * (1 - (idle - prev[1]) / (total - prev[0])), 1)
+    else:
+        cpu = 0.0
+
+    mem_total = mem_avail = None
+    for line in _read_proc("/proc/meminfo").split(b"\n"):
+        if line.startswith(b"MemTotal:"): mem_total = int(line.split()[1])
+        elif line.startswith(b"MemAvailable:"): mem_avail = int(line.split()[1]); break
+    if mem_total and mem_avail is not None:
+        mem = round(100.0 * (mem_total - mem_avail) / mem_total, 1)
+    else:
+        mem = psutil.virtual_memory().percent  # pre-3.14 kernels lack MemAvailable
+
+    sent = recv = 0
+    for line in _read_proc("/proc/net/dev").split(b"\n")[2:]:
+        if b":" not in line: continue
+        cols = line.split(b":", 1)[1].split()
+        recv += int(cols[0])
+        sent += int(cols[8])
+
+    return cpu, mem, sent, recv
+
+def disk_percent(path):
+    if not HAS_STATVFS:
+        return psutil.disk_usage(path).percent
+    # same formula as psutil: blocks reserved for root count as neither used nor available
+    st = os.statvfs(path)
+    used = st.f_blocks - st.f_bfree
+    total_user = used + st.f_bavail
+    return round(100.0 * used / total_user, 1) if total_user else 0.0
+
+def get_snapshot(prev_net, disk_cache, disk_poll_interval=30):
+    if PROC_FAST:
+        cpu, mem, sent, recv = _proc_snapshot()
+    else:
+        cpu = psutil.cpu_percent(interval=None)
+        mem = psutil.virtual_memory().percent
+        net = psutil.net_io_counters()
+        sent, recv = net.bytes_sent, net.bytes_recv
+    # disk % moves on a minute scale, so only re-poll it every disk_poll_interval seconds
+    t = time.monotonic()
+    if disk_cache.get("value") is None or t - disk_cache["last_ts"] > disk_poll_interval:
+        disk_cache["value"], disk_cache["last_ts"] = disk_percent("/"), t
+    disk = disk_cache["value"]
 
     d_sent = max(0, sent - prev_net[0]) if prev_net else 0
     d_recv = max(0, recv - prev_net[1]) if prev_net else 0
 
     return cpu, mem, disk, sent, recv, d_sent, d_recv
 
+_UNITS = ("B","KB","MB","GB","TB")
+
 def fmt_bytes(n):
-    for unit in ["B","KB","MB","GB","TB"]:
-        if n < 1024: return f"{n:.1f} {unit}" if n < 10 else f"{int(n)} {unit}"
-        n /= 1024
-    return f"{int(n)} TB"
+    # unit index straight from the bit length (1024 == 2**10) instead of a divide loop
+    i = min(4, max(0, (int(n).bit_length() - 1) // 10))
+    v = n / (1 << (10 * i))
+    return f"{v:.1f} {_UNITS[i]}" if v < 10 else f"{int(v)} {_UNITS[i]}"
 
 def main():
     p = argparse.ArgumentParser(description="System Health Monitor")
@@ -61,42 +264,102 @@ def main():
     p.add_argument("--cpu-th", type=int, default=80)
     p.add_argument("--mem-th", type=int, default=80)
     p.add_argument("--disk-th", type=int, default=90)
+    p.add_argument("--disk-poll-interval", type=float, default=30, help="Seconds between disk usage polls")
     p.add_argument("--log-file", default=os.path.join("logs","system_health.log"))
     p.add_argument("--log-max-bytes", type=int, default=1_000_000)
     p.add_argument("--log-backups", type=int, default=5)
     p.add_argument("--db", help="SQLite DB path")
+    p.add_argument("--metrics-only-to-db", action="store_true",
+                   help="Store samples only in the DB; log file keeps WARNING and above")
+    p.add_argument("--db-batch", type=int, default=1, help="Samples to buffer per DB transaction")
+    p.add_argument("--db-synchronous", choices=["OFF","NORMAL","FULL"], default="NORMAL",
+                   help="SQLite synchronous mode (OFF trades durability for speed)")
     args = p.parse_args()
+    if args.metrics_only_to_db and not args.db: p.error("--metrics-only-to-db requires --db")
+
+    logger = init_logger(args.log_file, args.log_max_bytes, args.log_backups, args.metrics_only_to_db)
+    conn = init_db(args.db, args.db_synchronous) if args.db else None
+    if conn:
+        db_q = queue.Queue()
+        writer = threading.Thread(target=db_writer, args=(db_q, conn, max(1, args.db_batch)),
+                                  name="db-writer", daemon=True)
+        writer.start()
+
+        def stop_writer():
+            if writer.is_alive():
+                db_q.put(None)
+                writer.join()
+        atexit.register(stop_writer)
 
-    logger = init_logger(args.log_file, args.log_max_bytes, args.log_backups)
-    conn = init_db(args.db) if args.db else None
-    cur = conn.cursor() if conn else None
+    # SIGINT/SIGTERM just set a flag; the wakeup socket interrupts the inter-sample wait so
+    # shutdown (and the final DB flush) happens immediately. A socketpair also works on Windows.
+    stopping = False
+    wake_r, wake_w = socket.socketpair()
+    wake_r.setblocking(False)
+    wake_w.setblocking(False)
+    signal.set_wakeup_fd(wake_w.fileno())
+    sel = selectors.DefaultSelector()
+    sel.register(wake_r, selectors.EVENT_READ)
 
-    start = time.time()
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    info_enabled = logger.isEnabledFor(logging.INFO)
+    cpu_th, mem_th, disk_th = args.cpu_th, args.mem_th, args.disk_th
+    interval = max(1, args.interval)
+    start = next_tick = time.monotonic()
     prev_net = None
+    disk_cache = {}
 
-    while True:
+    while not stopping:
         now = iso_now()
-        cpu, mem, disk, sent, recv, d_sent, d_recv = get_snapshot(prev_net)
+        cpu, mem, disk, sent, recv, d_sent, d_recv = get_snapshot(prev_net, disk_cache, args.disk_poll_interval)
 
-        msg = f"CPU: {cpu:.1f}%, MEM: {mem:.1f}%, DISK: {disk:.1f}%, NET Δ Sent: {fmt_bytes(d_sent)}, Δ Recv: {fmt_bytes(d_recv)}"
-        logger.info(msg)
+        if info_enabled:
+            logger.info("CPU: %.1f%%, MEM: %.1f%%, DISK: %.1f%%, NET Δ Sent: %s, Δ Recv: %s",
+                        cpu, mem, disk, fmt_bytes(d_sent), fmt_bytes(d_recv))
 
-        if cpu >= args.cpu_th: logger.warning(f"High CPU Usage: {cpu:.1f}%")
-        if mem >= args.mem_th: logger.warning(f"High Memory Usage: {mem:.1f}%")
-        if disk >= args.disk_th: logger.error(f"Disk Usage Critical: {disk:.1f}%")
+        cpu_hot, mem_hot, disk_hot = cpu >= cpu_th, mem >= mem_th, disk >= disk_th
+        event_rows = ()
+        if cpu_hot or mem_hot or disk_hot:
+            # each message is formatted once and shared by the log and the DB row
+            event_rows = []
+            if cpu_hot:
+                m = f"High CPU Usage: {cpu:.1f}%"
+                logger.warning(m)
+                event_rows.append((now,"WARNING",m))
+            if mem_hot:
+                m = f"High Memory Usage: {mem:.1f}%"
+                logger.warning(m)
+                event_rows.append((now,"WARNING",m))
+            if disk_hot:
+                m = f"Disk Usage Critical: {disk:.1f}%"
+                logger.error(m)
+                event_rows.append((now,"ERROR",m))
 
-        if conn:
-            cur.execute("INSERT INTO metrics VALUES (?,?,?,?,?,?)", (now, cpu, mem, disk, sent, recv))
-            if cpu >= args.cpu_th: cur.execute("INSERT INTO events VALUES (?,?,?)", (now,"WARNING",f"High CPU Usage: {cpu:.1f}%"))
-            if mem >= args.mem_th: cur.execute("INSERT INTO events VALUES (?,?,?)", (now,"WARNING",f"High Memory Usage: {mem:.1f}%"))
-            if disk >= args.disk_th: cur.execute("INSERT INTO events VALUES (?,?,?)", (now,"ERROR",f"Disk Usage Critical: {disk:.1f}%"))
-            conn.commit()
+        if conn: db_q.put(((now, cpu, mem, disk, sent, recv), event_rows))
 
         prev_net = (sent, recv)
-        if args.duration and (time.time()-start) >= args.duration: break
-        time.sleep(max(1, args.interval))
+        if stopping or (args.duration and (time.monotonic()-start) >= args.duration): break
+        # sleep to the next slot on a fixed grid so the work time doesn't accumulate as drift
+        next_tick += interval
+        t = time.monotonic()
+        if next_tick < t: next_tick = t  # overran a whole slot (e.g. suspend): don't burst to catch up
+        # wait on the wakeup socket rather than sleeping so a signal ends the wait at once
+        if sel.select(timeout=next_tick - t): wake_r.recv(4096)
+
+    signal.set_wakeup_fd(-1)
+    sel.close()
+    wake_r.close()
+    wake_w.close()
 
-    if conn: conn.close()
+    if conn:
+        stop_writer()
+        atexit.unregister(stop_writer)
+        conn.close()
 
 if __name__ == "__main__":
     main()